@@ -1,13 +1,34 @@
 import os
-import pandas as pd
-import requests
+import asyncio
+import httpx
 import base64
+import csv
+import json
+import time
 import hashlib
 import webbrowser
 import secrets
-from urllib.parse import urlencode
-from http.server import BaseHTTPRequestHandler, HTTPServer
-import threading
+from urllib.parse import urlencode, urlparse, parse_qs
+import socket
+
+# orjson is optional; it parses API responses considerably faster than the stdlib
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+# h2 is optional (installed by httpx[http2]); without it the API calls fall back to HTTP/1.1
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+# uvloop is optional; it replaces asyncio's pure-Python event loop with one built on libuv
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
 
 # --- Configuration ---
 # IMPORTANT: Set these environment variables before running the script.
@@ -21,55 +42,151 @@ CLIENT_ID = os.getenv('SPOTIPY_CLIENT_ID')
 REDIRECT_URI = os.getenv('SPOTIPY_REDIRECT_URI')
 SCOPE = 'user-top-read'
 OUTPUT_FILENAME = 'spotify_listening_history.csv'
+CSV_BUFFER_SIZE = 1024 * 1024
+TOKEN_CACHE_FILENAME = os.path.expanduser('~/.spotify_mind_map_token.json')
 
 # --- Spotify API Endpoints ---
 AUTH_URL = 'https://accounts.spotify.com/authorize'
 TOKEN_URL = 'https://accounts.spotify.com/api/token'
 API_BASE_URL = 'https://api.spotify.com/v1/'
+TIME_RANGES = ['short_term', 'medium_term', 'long_term']
+AUDIO_FEATURES_BATCH_SIZE = 100
+AUDIO_FEATURES_WORKERS = 4
+API_MAX_RETRIES = 3
+API_BACKOFF_FACTOR = 0.3
+API_MAX_RETRY_DELAY = 30
+RETRY_STATUS_CODES = (429, 500, 502, 503)
 
-# This will be used to store the authorization code received from Spotify
-auth_code_holder = {}
+# --- CSV Columns ---
+TRACK_COLUMNS = ['track_id', 'track_name', 'artist_name', 'album_name', 'popularity', 'duration_ms']
+FEATURE_COLUMNS = [
+    'danceability', 'energy', 'key', 'loudness', 'mode', 'speechiness',
+    'acousticness', 'instrumentalness', 'liveness', 'valence', 'tempo',
+]
+# Appended after the audio features so the other columns keep their positions
+EXTRA_COLUMNS = ['time_ranges']
 
 def generate_code_verifier_and_challenge():
     """Generates a code verifier and its corresponding code challenge for PKCE."""
     code_verifier = secrets.token_urlsafe(64)
+    # sha256 is in hashlib.algorithms_guaranteed and backed by OpenSSL, which uses the
+    # SHA-NI instructions where available; hashing the ~86 byte verifier is negligible.
     hashed = hashlib.sha256(code_verifier.encode('utf-8')).digest()
     code_challenge = base64.urlsafe_b64encode(hashed).rstrip(b'=').decode('utf-8')
     return code_verifier, code_challenge
 
-class CallbackHandler(BaseHTTPRequestHandler):
-    """A simple HTTP server handler to catch the Spotify callback."""
-    def do_GET(self):
-        global auth_code_holder
-        # Parse the query parameters from the request
-        if 'code' in self.path:
-            query = self.path.split('?')[1]
-            params = dict(p.split('=') for p in query.split('&'))
-            auth_code_holder['code'] = params['code']
-            
-            # Respond to the browser
-            self.send_response(200)
-            self.send_header('Content-type', 'text/html')
-            self.end_headers()
-            self.wfile.write(b"<h1>Authentication successful!</h1><p>You can close this window now.</p>")
-        else:
-            self.send_response(400)
-            self.end_headers()
-            self.wfile.write(b"<h1>Authentication failed.</h1><p>Please try again.</p>")
-
 def start_callback_server():
-    """Starts a temporary local server to handle the OAuth callback."""
-    server = HTTPServer(('localhost', 8888), CallbackHandler)
-    thread = threading.Thread(target=server.serve_forever)
-    thread.daemon = True
-    thread.start()
+    """Opens a temporary local socket to catch the OAuth callback."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(('localhost', 8888))
+    sock.listen(5)
     print("🚀 Local server started on port 8888 to catch Spotify callback...")
-    return server
+    return sock
+
+def send_callback_response(conn, response):
+    """Sends a raw HTTP response, ignoring browsers that already dropped the connection."""
+    try:
+        conn.sendall(response)
+    except (socket.timeout, ConnectionResetError, BrokenPipeError):
+        pass
+
+def wait_for_auth_code(sock, timeout=300, read_timeout=5):
+    """
+    Blocks until Spotify redirects the browser back with an authorization code.
+
+    Connections that send nothing within read_timeout seconds (e.g. speculative
+    pre-connections opened by the browser) are dropped so they can't block the callback.
+
+    Returns:
+        str: The authorization code. Returns None on timeout or if authorization was denied.
+    """
+    deadline = time.monotonic() + timeout
+    try:
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            sock.settimeout(remaining)
+            try:
+                conn, _ = sock.accept()
+            except socket.timeout:
+                return None
+            with conn:
+                conn.settimeout(min(read_timeout, remaining))
+                try:
+                    data = conn.recv(4096)
+                except (socket.timeout, ConnectionResetError):
+                    continue
+                if not data:
+                    continue
+                request_line = data.split(b'\r\n', 1)[0].split(b' ')
+                path = request_line[1].decode('utf-8', 'replace') if len(request_line) > 1 else ''
+                params = parse_qs(urlparse(path).query)
+                if 'code' in params:
+                    send_callback_response(conn, b"HTTP/1.0 200 OK\r\nContent-Type: text/html\r\n\r\n"
+                                         b"<h1>Authentication successful!</h1><p>You can close this window now.</p>")
+                    return params['code'][0]
+                if 'error' in params:
+                    send_callback_response(conn, b"HTTP/1.0 400 Bad Request\r\nContent-Type: text/html\r\n\r\n"
+                                         b"<h1>Authentication failed.</h1><p>Please try again.</p>")
+                    return None
+                # Anything else (e.g. /favicon.ico) is not the callback; keep waiting
+                send_callback_response(conn, b"HTTP/1.0 404 Not Found\r\n\r\n")
+    finally:
+        sock.close()
+        print("🛑 Local server stopped.")
+
+def load_cached_token():
+    """
+    Returns the cached access token if it has not expired yet and was issued for the
+    current client ID and scope, otherwise None.
+    """
+    try:
+        with open(TOKEN_CACHE_FILENAME) as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(cached, dict):
+        return None
+    if cached.get('client_id') != CLIENT_ID or cached.get('scope') != SCOPE:
+        return None
+    try:
+        if cached.get('expires_at', 0) > time.time():
+            return cached.get('access_token')
+    except TypeError:
+        pass
+    return None
+
+def save_cached_token(token_data):
+    """Saves the access token to disk, expiring it a minute early to be safe."""
+    access_token = token_data.get('access_token')
+    expires_in = token_data.get('expires_in')
+    if not access_token or expires_in is None:
+        return
+    try:
+        cached = {
+            'access_token': access_token,
+            'expires_at': time.time() + expires_in - 60,
+            'client_id': CLIENT_ID,
+            'scope': SCOPE,
+        }
+        # Create the file readable by the owner only, before the token is written to it
+        fd = os.open(TOKEN_CACHE_FILENAME, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            if hasattr(os, 'fchmod'):
+                # The mode above only applies to new files; tighten one left by an older run too
+                os.fchmod(f.fileno(), 0o600)
+            json.dump(cached, f)
+    except (KeyError, TypeError, OSError) as e:
+        print(f"⚠️ Could not cache access token: {e}")
 
-def stop_callback_server(server):
-    """Shuts down the local server."""
-    server.shutdown()
-    print("🛑 Local server stopped.")
+def clear_cached_token():
+    """Removes the cached access token, e.g. after Spotify rejected it."""
+    try:
+        os.remove(TOKEN_CACHE_FILENAME)
+    except FileNotFoundError:
+        pass
 
 def authenticate_spotify():
     """
@@ -78,6 +195,12 @@ def authenticate_spotify():
     Returns:
         str: An access token for making API requests. Returns None if authentication fails.
     """
+    # Checked first so warm runs skip PKCE generation, the callback server and the browser
+    cached_token = load_cached_token()
+    if cached_token:
+        print("✅ Reusing cached Spotify access token.")
+        return cached_token
+
     if not all([CLIENT_ID, REDIRECT_URI]):
         print("🔴 Error: Make sure you have set SPOTIPY_CLIENT_ID and SPOTIPY_REDIRECT_URI.")
         return None
@@ -100,12 +223,8 @@ def authenticate_spotify():
     print("👉 Opening your browser for Spotify authorization...")
     webbrowser.open(auth_url)
     
-    # 3. Wait for the authorization code from the callback
-    while 'code' not in auth_code_holder:
-        pass
-    stop_callback_server(server)
-    
-    auth_code = auth_code_holder.get('code')
+    # 3. Wait for the authorization code from the callback (up to 5 minutes)
+    auth_code = wait_for_auth_code(server)
     if not auth_code:
         print("🔴 Could not retrieve authorization code.")
         return None
@@ -119,88 +238,160 @@ def authenticate_spotify():
         'code_verifier': code_verifier,
     }
     
+    token_res = None
     try:
-        token_res = requests.post(TOKEN_URL, data=token_payload)
+        token_res = httpx.post(TOKEN_URL, data=token_payload)
         token_res.raise_for_status()
-        token_data = token_res.json()
+        token_data = json_loads(token_res.content)
+        save_cached_token(token_data)
         print("✅ Successfully authenticated with Spotify using PKCE!")
         return token_data.get('access_token')
-    except requests.exceptions.RequestException as e:
+    except (httpx.HTTPError, ValueError) as e:
         print(f"🔴 Failed to get access token: {e}")
-        print(f"   Response: {token_res.text}")
+        if token_res is not None:
+            print(f"   Response: {token_res.text}")
         return None
 
-def get_top_tracks(access_token, time_range='medium_term', limit=50):
+async def get_with_retries(client, url, params):
+    """
+    Sends a GET request, retrying rate-limited (429) and transient server errors.
+
+    Waits for the Retry-After header when Spotify sends one, otherwise backs off exponentially.
+    Gives up if Spotify asks to wait longer than API_MAX_RETRY_DELAY seconds.
+    """
+    for attempt in range(API_MAX_RETRIES + 1):
+        res = await client.get(url, params=params)
+        if res.status_code not in RETRY_STATUS_CODES or attempt == API_MAX_RETRIES:
+            return res
+        try:
+            delay = float(res.headers['Retry-After'])
+        except (KeyError, ValueError):
+            delay = API_BACKOFF_FACTOR * (2 ** attempt)
+        if delay > API_MAX_RETRY_DELAY:
+            print(f"⚠️ Spotify returned {res.status_code} and asked to retry in {delay:.0f}s; giving up.")
+            return res
+        print(f"⏳ Spotify returned {res.status_code}; retrying in {delay:.1f}s...")
+        await asyncio.sleep(delay)
+
+async def get_top_tracks(client, time_range='medium_term', limit=50):
     """Fetches the user's top tracks using a direct API call."""
     print(f"\nFetching top {limit} tracks for time range: {time_range}...")
-    headers = {'Authorization': f'Bearer {access_token}'}
     params = {'time_range': time_range, 'limit': limit}
     try:
-        res = requests.get(API_BASE_URL + 'me/top/tracks', headers=headers, params=params)
+        res = await get_with_retries(client, 'me/top/tracks', params)
+        if res.status_code == 401:
+            clear_cached_token()
         res.raise_for_status()
-        results = res.json()
+        results = json_loads(res.content)
         print(f"✅ Found {len(results['items'])} tracks.")
         return results['items']
-    except requests.exceptions.RequestException as e:
+    except (httpx.HTTPError, ValueError) as e:
         print(f"🔴 Could not fetch top tracks: {e}")
         return []
 
-def get_audio_features(access_token, track_ids):
-    """Fetches audio features using a direct API call."""
+def chunked(lst, n):
+    """Splits a list into consecutive chunks of at most n items."""
+    return [lst[i:i + n] for i in range(0, len(lst), n)]
+
+async def get_audio_features(client, track_ids):
+    """Fetches audio features using direct API calls, 100 IDs per request."""
     print("Fetching audio features for tracks...")
-    headers = {'Authorization': f'Bearer {access_token}'}
-    params = {'ids': ','.join(track_ids)}
-    try:
-        res = requests.get(API_BASE_URL + 'audio-features', headers=headers, params=params)
+    # Limits the number of requests in flight to stay under Spotify's rate limits
+    semaphore = asyncio.Semaphore(AUDIO_FEATURES_WORKERS)
+
+    async def fetch_chunk(ids):
+        async with semaphore:
+            res = await get_with_retries(client, 'audio-features', {'ids': ','.join(ids)})
+        if res.status_code == 401:
+            clear_cached_token()
+        if res.status_code == 403:
+            # Spotify has deprecated this endpoint for new apps (November 2024)
+            return None
         res.raise_for_status()
-        features = res.json()['audio_features']
-        print("✅ Audio features fetched successfully.")
+        return json_loads(res.content)['audio_features']
+
+    try:
+        # Spotify caps this endpoint at 100 IDs per request. The first chunk is fetched
+        # on its own so the rest are never requested if the endpoint is unavailable.
+        first_chunk, *other_chunks = chunked(track_ids, AUDIO_FEATURES_BATCH_SIZE)
+        first = await fetch_chunk(first_chunk)
+        if first is None:
+            print("⚠️ Audio features are unavailable for this app (403); skipping.")
+            return []
+        other_results = await asyncio.gather(*[fetch_chunk(ids) for ids in other_chunks])
+        features = first + [f for chunk in other_results if chunk is not None for f in chunk]
+        skipped = sum(len(ids) for ids, chunk in zip(other_chunks, other_results) if chunk is None)
+        if skipped:
+            print(f"⚠️ Audio features were refused (403) for {skipped} tracks; they are left without features.")
+        else:
+            print("✅ Audio features fetched successfully.")
         return features
-    except requests.exceptions.RequestException as e:
+    except (httpx.HTTPError, ValueError) as e:
         print(f"🔴 Could not fetch audio features: {e}")
         return []
 
+async def fetch_all(access_token):
+    """
+    Fetches the top tracks for every time range and their audio features.
+
+    All requests are multiplexed over a single HTTP/2 connection when h2 is installed.
+
+    Returns:
+        tuple: The de-duplicated top tracks and their audio features.
+    """
+    async with httpx.AsyncClient(
+        base_url=API_BASE_URL,
+        headers={'Authorization': f'Bearer {access_token}'},
+        transport=httpx.AsyncHTTPTransport(http2=HTTP2_AVAILABLE, retries=3),
+    ) as client:
+        results = await asyncio.gather(*[get_top_tracks(client, tr) for tr in TIME_RANGES])
+
+        # Merge the ranges, recording every range each track appeared in
+        top_tracks = {}
+        for time_range, tracks in zip(TIME_RANGES, results):
+            for track in tracks:
+                top_tracks.setdefault(track['id'], {**track, 'time_ranges': []})['time_ranges'].append(time_range)
+        top_tracks = list(top_tracks.values())
+
+        if not top_tracks:
+            return [], []
+        audio_features = await get_audio_features(client, [track['id'] for track in top_tracks])
+        return top_tracks, audio_features
+
+def flatten_track(track, features):
+    """Flattens a track and its audio features into a single CSV row."""
+    row = {
+        'track_id': track['id'],
+        'track_name': track['name'],
+        'artist_name': ', '.join(artist['name'] for artist in track['artists']),
+        'album_name': track['album']['name'],
+        'popularity': track['popularity'],
+        'duration_ms': track['duration_ms'],
+    }
+    for column in FEATURE_COLUMNS:
+        row[column] = features.get(column)
+    row['time_ranges'] = ', '.join(track['time_ranges'])
+    return row
+
 def process_and_save_data(tracks, audio_features):
-    """Cleans, structures, and saves the track and audio feature data to a CSV file."""
-    if not tracks or not audio_features:
+    """Cleans, structures, and streams the track and audio feature data to a CSV file."""
+    if not tracks:
         print("🔴 No data to process. Exiting.")
         return
 
     print("\nProcessing and structuring data...")
-    all_tracks_data = []
     features_dict = {f['id']: f for f in audio_features if f}
+    # Without any audio features only the track-level columns are written
+    fieldnames = TRACK_COLUMNS + (FEATURE_COLUMNS if features_dict else []) + EXTRA_COLUMNS
 
-    for track in tracks:
-        track_info = {
-            'track_id': track['id'],
-            'track_name': track['name'],
-            'artist_name': ', '.join([artist['name'] for artist in track['artists']]),
-            'album_name': track['album']['name'],
-            'popularity': track['popularity'],
-            'duration_ms': track['duration_ms']
-        }
-        features = features_dict.get(track['id'])
-        if features:
-            track_info.update({
-                'danceability': features.get('danceability'),
-                'energy': features.get('energy'),
-                'key': features.get('key'),
-                'loudness': features.get('loudness'),
-                'mode': features.get('mode'),
-                'speechiness': features.get('speechiness'),
-                'acousticness': features.get('acousticness'),
-                'instrumentalness': features.get('instrumentalness'),
-                'liveness': features.get('liveness'),
-                'valence': features.get('valence'),
-                'tempo': features.get('tempo'),
-            })
-        all_tracks_data.append(track_info)
-
-    df = pd.DataFrame(all_tracks_data)
     try:
-        df.to_csv(OUTPUT_FILENAME, index=False)
+        # Rows are written one at a time through a 1MB buffer; no intermediate table is built
+        with open(OUTPUT_FILENAME, 'w', newline='', encoding='utf-8', buffering=CSV_BUFFER_SIZE) as f:
+            writer = csv.DictWriter(f, fieldnames=fieldnames, extrasaction='ignore')
+            writer.writeheader()
+            writer.writerows(flatten_track(t, features_dict.get(t['id'], {})) for t in tracks)
         print(f"✅ Data successfully saved to '{OUTPUT_FILENAME}'")
-        print(f"Total tracks processed: {len(df)}")
+        print(f"Total tracks processed: {len(tracks)}")
     except Exception as e:
         print(f"🔴 Failed to save data to CSV: {e}")
 
@@ -212,15 +403,12 @@ def main():
     token = authenticate_spotify()
     
     if token:
-        # 2. Extract Data
-        top_tracks = get_top_tracks(token)
+        # 2. Extract Data and 3. Get Audio Features
+        # uvloop.run only exists in uvloop 0.18+; older versions use the default loop
+        run = getattr(uvloop, 'run', None) or asyncio.run
+        top_tracks, audio_features = run(fetch_all(token))
         
         if top_tracks:
-            track_ids = [track['id'] for track in top_tracks]
-            
-            # 3. Get Audio Features
-            audio_features = get_audio_features(token, track_ids)
-            
             # 4. Clean, Structure, and Save
             process_and_save_data(top_tracks, audio_features)
 